@@ -1,18 +1,20 @@
-import io, time, base64, json
-import torch
+import time, base64
 import asyncio
 import uvicorn
+import msgpack
+import orjson
 import requests
 import argparse
-from PIL import Image
 from pydantic import BaseModel
 from typing import Dict, Optional, AsyncGenerator
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from sp_logging import setup_logging, RequestIdMiddleware
-
-from controlnet_aux import DWposeDetector
+from pose_batcher import put_latest
+from pose_model import init_pose_model, get_batcher, close_batcher, get_codec_pool, close_codec_pool
+from pose_codec import decode_frame, encode_jpeg
+from pose_accel import BACKENDS
 
 logger = setup_logging()
 PORT = 8293
@@ -20,7 +22,6 @@ PORT = 8293
 app = FastAPI()
 app.add_middleware(RequestIdMiddleware)
 
-dwpose = DWposeDetector("cuda:0" if torch.cuda.is_available() else "cpu")
 
 class PoseParams(BaseModel):
     image: str
@@ -28,40 +29,69 @@ class PoseParams(BaseModel):
 class PoseResponse(BaseModel):
     image: str
 
+async def receive_frames(websocket: WebSocket, frames: asyncio.Queue):
+    """Keep only the newest unprocessed message so latency can't build up behind slow pose passes"""
+    try:
+        while True:
+            message = await websocket.receive()
+            put_latest(frames, message)
+            if message["type"] == "websocket.disconnect":
+                return
+    except Exception as e:
+        logger.error(f"WebSocket receive error: {e}")
+        put_latest(frames, {"type": "websocket.disconnect", "code": 1011})
+
 @app.websocket("/pose")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     logger.info("WebSocket connection established")
+    loop = asyncio.get_running_loop()
+    frames = asyncio.Queue(maxsize=1)
+    reader = asyncio.create_task(receive_frames(websocket, frames))
 
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-
-            image_data = message["image"].split(",")[-1]
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-            image = image.transpose(Image.FLIP_LEFT_RIGHT)
+            message = await frames.get()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+            # Binary frames are msgpack with raw JPEG bytes, text frames JSON with a base64 data URL
+            binary = message.get("bytes") is not None
+            if binary:
+                image_bytes = msgpack.unpackb(message["bytes"])["image"]
+            else:
+                image_data = orjson.loads(message["text"])["image"].split(",")[-1]
+                image_bytes = base64.b64decode(image_data)
+            image = await loop.run_in_executor(get_codec_pool(), decode_frame, image_bytes)
 
             start_time = time.time()
-            result = dwpose(image, output_type="pil", include_hands=True, include_face=True)
+            result = await get_batcher().enqueue(image)
             end_time = time.time()
 
             execution_time = end_time - start_time
             print(f"dwpose took {execution_time:.4f} seconds")
 
-            buffered = io.BytesIO()
-            result.save(buffered, format="JPEG", quality=85)
-            result_image = base64.b64encode(buffered.getvalue()).decode()
+            result_jpeg = await loop.run_in_executor(get_codec_pool(), encode_jpeg, result)
 
-            response = {"image": result_image}
-            await websocket.send_text(json.dumps(response))
+            if binary:
+                response = {"image": result_jpeg, "t": execution_time}
+                await websocket.send_bytes(msgpack.packb(response, use_bin_type=True))
+            else:
+                response = {"image": base64.b64encode(result_jpeg).decode()}
+                await websocket.send_text(orjson.dumps(response).decode())
 
     except WebSocketDisconnect:
         logger.info("WebSocket client disconnected")
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
         await websocket.close(code=1011, reason="Internal server error")
+    finally:
+        reader.cancel()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_batcher()
+    close_codec_pool()
 
 @app.get("/health", status_code=200)
 async def index():
@@ -70,8 +100,11 @@ async def index():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--origin", default="http://localhost:5173", help="Allowed CORS origin")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager", help="How to run the pose backbones")
     args = parser.parse_args()
 
+    init_pose_model(args.backend)
+
     app.add_middleware(
         CORSMiddleware,
         allow_origins=[args.origin],
@@ -85,6 +118,9 @@ if __name__ == "__main__":
         app,
         host="0.0.0.0",
         port=PORT,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
         log_level="error",
         log_config=None
     )
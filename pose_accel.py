@@ -0,0 +1,334 @@
+import os
+import logging
+
+import torch
+import numpy as np
+
+from pose_batcher import MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "cudagraph", "compile", "tensorrt", "int8")
+ENGINE_DIR = "engines"
+# Persons per frame the pose engines are sized for, beyond that the original backbone runs
+PERSONS_PER_FRAME = 4
+
+
+class Features(torch.nn.Module):
+    """Backbone and optional neck fused into a single module so they compile as one graph"""
+
+    def __init__(self, backbone, neck=None):
+        super().__init__()
+        self.backbone = backbone
+        self.neck = neck
+
+    def forward(self, x):
+        x = self.backbone(x)
+        return self.neck(x) if self.neck is not None else x
+
+
+class AcceleratedFeatures(torch.nn.Module):
+    """Runs an accelerated feature extractor, falling back to the original outside its batch range"""
+
+    def __init__(self, features: Features, accelerated, max_batch_size: int):
+        super().__init__()
+        self.features = features
+        self.accelerated = accelerated
+        self.max_batch_size = max_batch_size
+
+    def forward(self, x):
+        if x.shape[0] > self.max_batch_size:
+            return self.features(x)
+        return tuple(self.accelerated(x))
+
+
+def _padded_batch_size(batch_size: int) -> int:
+    # Pad to the next power of two so a handful of graphs covers every batch size
+    return 1 << (batch_size - 1).bit_length()
+
+
+class CUDAGraphFeatures(torch.nn.Module):
+    """Replays a captured CUDA graph per padded batch size instead of launching every kernel from Python
+
+    Outputs are copied out of the graph's static buffers, the pose estimator's flip
+    test extracts features twice per batch and the second replay would overwrite the first.
+    """
+
+    def __init__(self, features: Features, warmup_iters: int = 3):
+        super().__init__()
+        self.features = features
+        self.warmup_iters = warmup_iters
+        self.graphs = {}
+
+    def _capture(self, static_input):
+        device = static_input.device
+        # Warm up on a side stream so lazy initialisation isn't recorded into the graph
+        stream = torch.cuda.Stream(device=device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                self.features(static_input)
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = tuple(self.features(static_input))
+        return graph, static_input, static_output
+
+    def forward(self, x):
+        batch_size = x.shape[0]
+        padded = _padded_batch_size(batch_size)
+        autocast = torch.is_autocast_enabled()
+        key = (padded, *x.shape[1:], x.dtype, autocast)
+
+        # dwpose_batch's autocast caches fp16 weight casts and frees them on exit, a graph
+        # captured against that cache would replay from freed memory, so keep the casts in the graph
+        with torch.autocast("cuda", dtype=torch.get_autocast_gpu_dtype(), enabled=autocast, cache_enabled=False):
+            if key not in self.graphs:
+                static_input = torch.zeros((padded, *x.shape[1:]), dtype=x.dtype, device=x.device)
+                static_input[:batch_size].copy_(x)
+                self.graphs[key] = self._capture(static_input)
+                logger.debug(f"Captured CUDA graph for input shape {tuple(static_input.shape)}")
+
+            graph, static_input, static_output = self.graphs[key]
+            static_input[:batch_size].copy_(x)
+            graph.replay()
+        return tuple(out[:batch_size].clone() for out in static_output)
+
+
+class CompiledFeatures(torch.nn.Module):
+    """torch.compile'd feature extractor fed power-of-two batches, so only a few CUDA graphs get recorded
+
+    reduce-overhead replays CUDA graph trees that overwrite the previous call's outputs,
+    the pose estimator's flip test extracts features twice per batch so outputs are copied.
+    """
+
+    def __init__(self, features: Features, mode: str):
+        super().__init__()
+        self.compiled = torch.compile(features, mode=mode, fullgraph=False)
+
+    def forward(self, x):
+        batch_size = x.shape[0]
+        padded = _padded_batch_size(batch_size)
+        if padded != batch_size:
+            x = torch.cat([x, x.new_zeros((padded - batch_size, *x.shape[1:]))])
+        torch.compiler.cudagraph_mark_step_begin()
+        return tuple(out[:batch_size].clone() for out in self.compiled(x))
+
+
+class OnnxFeatures(torch.nn.Module):
+    """Runs an exported feature extractor in ONNXRuntime, binding torch tensors in place of copies"""
+
+    def __init__(self, path: str, device: torch.device, shape, max_batch_size: int):
+        super().__init__()
+        import onnxruntime as ort
+
+        self.device = device
+        if device.type == "cuda":
+            # TensorRT runs the QDQ graph on INT8 tensor cores, the CUDA provider picks up what it can't
+            device_id = device.index or 0
+
+            def profile(batch_size):
+                return "input:" + "x".join(str(d) for d in (batch_size, *shape))
+
+            providers = [
+                ("TensorrtExecutionProvider", {
+                    "device_id": device_id,
+                    "trt_int8_enable": True,
+                    "trt_engine_cache_enable": True,
+                    "trt_engine_cache_path": ENGINE_DIR,
+                    # Build one engine for the whole batch range up front instead of
+                    # rebuilding it mid-stream whenever a larger batch shows up
+                    "trt_profile_min_shapes": profile(1),
+                    "trt_profile_opt_shapes": profile(max_batch_size),
+                    "trt_profile_max_shapes": profile(max_batch_size),
+                }),
+                ("CUDAExecutionProvider", {"device_id": device_id}),
+                "CPUExecutionProvider",
+            ]
+        else:
+            providers = ["CPUExecutionProvider"]
+        self.session = ort.InferenceSession(path, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        # Only the batch axis is dynamic, the rest of each output shape is fixed at export
+        self.outputs = [(output.name, output.shape[1:]) for output in self.session.get_outputs()]
+
+    def forward(self, x):
+        x = x.float().contiguous()
+        device_type, device_id = self.device.type, self.device.index or 0
+        binding = self.session.io_binding()
+        binding.bind_input(self.input_name, device_type, device_id, np.float32, tuple(x.shape), x.data_ptr())
+
+        outputs = []
+        for name, shape in self.outputs:
+            out = torch.empty((x.shape[0], *shape), dtype=torch.float32, device=self.device)
+            binding.bind_output(name, device_type, device_id, np.float32, tuple(out.shape), out.data_ptr())
+            outputs.append(out)
+
+        if device_type == "cuda":
+            # ONNXRuntime launches on its own stream, x must be ready before it reads it
+            torch.cuda.current_stream(self.device).synchronize()
+        self.session.run_with_iobinding(binding)
+        return tuple(outputs)
+
+
+def _feature_models(dwpose, max_batch_size: int):
+    """(name, model, input shape, max batch size) for the detector and the pose estimator"""
+    detector = dwpose.pose_estimation.detector
+    pose_estimator = dwpose.pose_estimation.pose_estimator
+
+    # YOLOX pads every frame to a square of its largest img_scale side
+    det_size = max(detector.cfg.img_scale)
+    pose_w, pose_h = pose_estimator.cfg.codec.input_size
+    return [
+        ("detector", detector, (3, det_size, det_size), max_batch_size),
+        ("pose_estimator", pose_estimator, (3, pose_h, pose_w), max_batch_size * PERSONS_PER_FRAME),
+    ]
+
+
+def _features(model) -> Features:
+    neck = model.neck if getattr(model, "with_neck", False) else None
+    return Features(model.backbone, neck).eval()
+
+
+def _swap_features(model, features: Features, accelerated, max_batch_size: int):
+    model.backbone = AcceleratedFeatures(features, accelerated, max_batch_size)
+    if features.neck is not None:
+        # The neck now runs inside the accelerated module
+        model.neck = None
+
+
+def enable_cuda_graphs(dwpose, max_batch_size: int = MAX_BATCH_SIZE):
+    """Run the detector and pose feature extractors through captured CUDA graphs
+
+    Only the feature extractors have fixed input shapes, the heads and
+    post-processing stay eager.
+    """
+    device = dwpose.pose_estimation.detector.data_preprocessor.device
+    if device.type != "cuda":
+        logger.warning("CUDA graphs need a CUDA device, keeping the eager backbones")
+        return dwpose
+
+    for name, model, shape, max_bs in _feature_models(dwpose, max_batch_size):
+        features = _features(model)
+        _swap_features(model, features, CUDAGraphFeatures(features), max_bs)
+        logger.info(f"Using CUDA graphs for the {name}")
+    return dwpose
+
+
+def enable_compile(dwpose, max_batch_size: int = MAX_BATCH_SIZE, mode: str = "reduce-overhead"):
+    """Compile the detector and pose feature extractors with torch.compile (Inductor)
+
+    Compilation happens lazily on the first forward of each padded batch size, warm up
+    through PoseBatcher.warmup so it doesn't land on the first clients.
+    """
+    for name, model, shape, max_bs in _feature_models(dwpose, max_batch_size):
+        features = _features(model)
+        _swap_features(model, features, CompiledFeatures(features, mode), max_bs)
+        logger.info(f"Compiled the {name} with torch.compile(mode={mode!r})")
+    return dwpose
+
+
+def enable_tensorrt(dwpose, max_batch_size: int = MAX_BATCH_SIZE, engine_dir: str = ENGINE_DIR):
+    """Replace the detector and pose feature extractors with fp16 TensorRT engines
+
+    Engines are built on first use and cached in engine_dir per GPU architecture,
+    pre/post-processing stays in mmdet/mmpose.
+    """
+    import torch_tensorrt
+
+    device = dwpose.pose_estimation.detector.data_preprocessor.device
+    if device.type != "cuda":
+        logger.warning("TensorRT needs a CUDA device, keeping the PyTorch backbones")
+        return dwpose
+
+    os.makedirs(engine_dir, exist_ok=True)
+    major, minor = torch.cuda.get_device_capability(device)
+
+    for name, model, shape, max_bs in _feature_models(dwpose, max_batch_size):
+        path = os.path.join(engine_dir, f"{name}_fp16_b{max_bs}_sm{major}{minor}.ts")
+        features = _features(model)
+
+        if os.path.exists(path):
+            engine = torch.jit.load(path, map_location=device)
+        else:
+            logger.info(f"Building TensorRT engine for the {name}, this can take several minutes")
+            with torch.no_grad():
+                traced = torch.jit.trace(features, torch.randn(1, *shape, device=device))
+            engine = torch_tensorrt.compile(
+                traced,
+                ir="ts",
+                inputs=[torch_tensorrt.Input(
+                    min_shape=(1, *shape),
+                    opt_shape=(max_bs, *shape),
+                    max_shape=(max_bs, *shape),
+                    dtype=torch.float32,
+                )],
+                enabled_precisions={torch.float32, torch.float16},
+            )
+            torch.jit.save(engine, path)
+
+        _swap_features(model, features, engine, max_bs)
+        logger.info(f"Using TensorRT engine {path} for the {name}")
+
+    return dwpose
+
+
+def int8_path(engine_dir: str, name: str) -> str:
+    return os.path.join(engine_dir, f"{name}_int8.onnx")
+
+
+def export_onnx(dwpose, max_batch_size: int = MAX_BATCH_SIZE, engine_dir: str = ENGINE_DIR):
+    """Export the detector and pose feature extractors to fp32 ONNX with a dynamic batch axis
+
+    Returns {name: path}, quantize.py turns these into the INT8 models enable_int8 loads.
+    """
+    os.makedirs(engine_dir, exist_ok=True)
+    paths = {}
+    for name, model, shape, max_bs in _feature_models(dwpose, max_batch_size):
+        features = _features(model)
+        dummy = torch.randn(1, *shape, device=model.data_preprocessor.device)
+        with torch.no_grad():
+            output_names = [f"output{i}" for i in range(len(tuple(features(dummy))))]
+
+        path = os.path.join(engine_dir, f"{name}.onnx")
+        torch.onnx.export(
+            features,
+            dummy,
+            path,
+            input_names=["input"],
+            output_names=output_names,
+            dynamic_axes={axis: {0: "batch"} for axis in ["input", *output_names]},
+            opset_version=17,
+        )
+        paths[name] = path
+        logger.info(f"Exported the {name} to {path}")
+    return paths
+
+
+def enable_int8(dwpose, max_batch_size: int = MAX_BATCH_SIZE, engine_dir: str = ENGINE_DIR):
+    """Run the detector and pose feature extractors from the INT8 ONNX models written by quantize.py"""
+    device = dwpose.pose_estimation.detector.data_preprocessor.device
+    for name, model, shape, max_bs in _feature_models(dwpose, max_batch_size):
+        path = int8_path(engine_dir, name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found, run quantize.py to build the INT8 models first")
+        features = _features(model)
+        _swap_features(model, features, OnnxFeatures(path, device, shape, max_bs), max_bs)
+        logger.info(f"Using INT8 ONNXRuntime model {path} for the {name}")
+    return dwpose
+
+
+def enable_backend(dwpose, backend: str, max_batch_size: int = MAX_BATCH_SIZE):
+    """Switch DWpose to one of BACKENDS, eager leaves the PyTorch models untouched"""
+    if backend == "cudagraph":
+        enable_cuda_graphs(dwpose, max_batch_size)
+    elif backend == "compile":
+        enable_compile(dwpose, max_batch_size)
+    elif backend == "tensorrt":
+        enable_tensorrt(dwpose, max_batch_size)
+    elif backend == "int8":
+        enable_int8(dwpose, max_batch_size)
+    elif backend != "eager":
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    return dwpose
@@ -0,0 +1,308 @@
+import asyncio
+import logging
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import cv2
+import torch
+import numpy as np
+from PIL import Image
+
+from mmcv.transforms import Compose
+from mmdet.utils import get_test_pipeline_cfg
+from mmengine.dataset import pseudo_collate
+from mmengine.registry import init_default_scope
+from mmpose.evaluation.functional import nms
+from mmpose.structures import merge_data_samples
+
+from controlnet_aux.dwpose import draw_pose
+from controlnet_aux.util import HWC3, resize_image
+
+from pose_codec import DETECT_RESOLUTION, detect_size
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 8
+MAX_WAIT = 0.005  # seconds to wait for more frames before running a batch
+
+# Same reordering Wholebody applies to map mmpose keypoints onto openpose indices
+MMPOSE_IDX = [17, 6, 8, 10, 7, 9, 12, 14, 16, 13, 15, 2, 1, 4, 3]
+OPENPOSE_IDX = [1, 2, 3, 4, 6, 7, 8, 9, 10, 12, 13, 14, 15, 16, 17]
+
+
+@lru_cache(maxsize=None)
+def _det_pipeline(detector):
+    cfg = detector.cfg.copy()
+    pipeline = get_test_pipeline_cfg(cfg)
+    pipeline[0].type = 'mmdet.LoadImageFromNDArray'
+    return Compose(pipeline)
+
+
+@lru_cache(maxsize=None)
+def _pose_pipeline(pose_estimator):
+    init_default_scope(pose_estimator.cfg.get('default_scope', 'mmpose'))
+    return Compose(pose_estimator.cfg.test_dataloader.dataset.pipeline)
+
+
+# Pinned staging buffers and copy streams, only ever touched from the inference thread
+_pinned_buffers = {}
+_copy_streams = {}
+
+
+def _pinned(shape, dtype, batch_size: int):
+    key = (shape, dtype)
+    buf, copied = _pinned_buffers.get(key, (None, None))
+    if buf is None or buf.shape[0] < batch_size:
+        buf, copied = torch.empty((batch_size, *shape), dtype=dtype, pin_memory=True), torch.cuda.Event()
+        _pinned_buffers[key] = (buf, copied)
+    # Don't overwrite the buffer while an earlier upload may still be reading from it
+    copied.synchronize()
+    return buf[:batch_size], copied
+
+
+def _to_device(inputs: List[torch.Tensor], device: torch.device) -> List[torch.Tensor]:
+    """Stage same-shape inputs in pinned memory and upload them with one async copy on a side stream"""
+    if device.type != "cuda" or len({t.shape for t in inputs}) != 1:
+        # Ragged batches are left to the data preprocessor's per-image copies
+        return inputs
+
+    host, copied = _pinned(inputs[0].shape, inputs[0].dtype, len(inputs))
+    torch.stack(inputs, out=host)
+
+    stream = _copy_streams.get(device)
+    if stream is None:
+        stream = _copy_streams[device] = torch.cuda.Stream(device=device)
+    compute = torch.cuda.current_stream(device)
+    with torch.cuda.stream(stream):
+        batch = host.to(device, non_blocking=True)
+        copied.record(stream)
+    compute.wait_stream(stream)
+    batch.record_stream(compute)
+    return list(batch.unbind(0))
+
+
+def _collate(data, model):
+    batch = pseudo_collate(data)
+    batch['inputs'] = _to_device(batch['inputs'], model.data_preprocessor.device)
+    return batch
+
+
+def _person_bboxes(det_result):
+    pred_instance = det_result.pred_instances.cpu().numpy()
+    bboxes = np.concatenate(
+        (pred_instance.bboxes, pred_instance.scores[:, None]), axis=1)
+    bboxes = bboxes[np.logical_and(pred_instance.labels == 0,
+                                   pred_instance.scores > 0.5)]
+    return bboxes[nms(bboxes, 0.7), :4]
+
+
+def _openpose_keypoints(preds):
+    keypoints = preds.get('transformed_keypoints', preds.keypoints)
+    if 'keypoint_scores' in preds:
+        scores = preds.keypoint_scores
+    else:
+        scores = np.ones(keypoints.shape[:-1])
+
+    if 'keypoints_visible' in preds:
+        visible = preds.keypoints_visible
+    else:
+        visible = np.ones(keypoints.shape[:-1])
+    keypoints_info = np.concatenate(
+        (keypoints, scores[..., None], visible[..., None]), axis=-1)
+
+    # compute neck joint
+    neck = np.mean(keypoints_info[:, [5, 6]], axis=1)
+    neck[:, 2:4] = np.logical_and(
+        keypoints_info[:, 5, 2:4] > 0.3,
+        keypoints_info[:, 6, 2:4] > 0.3).astype(int)
+    keypoints_info = np.insert(keypoints_info, 17, neck, axis=1)
+    keypoints_info[:, OPENPOSE_IDX] = keypoints_info[:, MMPOSE_IDX]
+
+    return keypoints_info[..., :2], keypoints_info[..., 2]
+
+
+def wholebody_batch(wholebody, frames: List[np.ndarray]):
+    """Batched equivalent of Wholebody.__call__: one detector and one pose forward for all frames"""
+    detector, pose_estimator = wholebody.detector, wholebody.pose_estimator
+
+    det_pipeline = _det_pipeline(detector)
+    det_data = [det_pipeline(dict(img=frame, img_id=0)) for frame in frames]
+    det_results = detector.test_step(_collate(det_data, detector))
+
+    pose_pipeline = _pose_pipeline(pose_estimator)
+    pose_data, counts = [], []
+    for frame, det_result in zip(frames, det_results):
+        bboxes = _person_bboxes(det_result)
+        if len(bboxes) == 0:
+            # No person found, fall back to the whole frame like inference_topdown does
+            h, w = frame.shape[:2]
+            bboxes = np.array([[0, 0, w, h]], dtype=np.float32)
+        for bbox in bboxes:
+            data_info = dict(img=frame, bbox=bbox[None], bbox_score=np.ones(1, dtype=np.float32))
+            data_info.update(pose_estimator.dataset_meta)
+            pose_data.append(pose_pipeline(data_info))
+        counts.append(len(bboxes))
+
+    pose_results = pose_estimator.test_step(_collate(pose_data, pose_estimator))
+
+    results, start = [], 0
+    for count in counts:
+        preds = merge_data_samples(pose_results[start:start + count]).pred_instances
+        results.append(_openpose_keypoints(preds))
+        start += count
+    return results
+
+
+def _draw(frame, candidate, subset, image_resolution, output_type):
+    H, W, C = frame.shape
+    nums, keys, locs = candidate.shape
+    candidate[..., 0] /= float(W)
+    candidate[..., 1] /= float(H)
+    body = candidate[:, :18].copy().reshape(nums * 18, locs)
+    score = subset[:, :18]
+    for i in range(len(score)):
+        for j in range(len(score[i])):
+            score[i][j] = int(18 * i + j) if score[i][j] > 0.3 else -1
+
+    candidate[subset < 0.3] = -1
+
+    faces = candidate[:, 24:92]
+    hands = np.vstack([candidate[:, 92:113], candidate[:, 113:]])
+    pose = dict(bodies=dict(candidate=body, subset=score), hands=hands, faces=faces)
+
+    detected_map = HWC3(draw_pose(pose, H, W))
+    H, W, C = resize_image(frame, image_resolution).shape
+    detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
+
+    if output_type == "pil":
+        detected_map = Image.fromarray(detected_map)
+    return detected_map
+
+
+def _prepare_frames(images, detect_resolution: int) -> List[np.ndarray]:
+    """BGR uint8 frames at DWpose's detection size, as DWposeDetector.__call__ builds them"""
+    arrays = [np.asarray(image, dtype=np.uint8) for image in images]
+    if len({a.shape for a in arrays}) != 1 or arrays[0].ndim != 3 or arrays[0].shape[2] != 3:
+        frames = []
+        for array in arrays:
+            frame = cv2.cvtColor(np.ascontiguousarray(array), cv2.COLOR_RGB2BGR)
+            frames.append(resize_image(HWC3(frame), detect_resolution))
+        return frames
+
+    # Same-shape RGB frames (the common case, decode_frame already resized them) are
+    # materialized and swapped to BGR in a single copy into one contiguous batch
+    batch = np.stack([a[..., ::-1] for a in arrays])
+    height, width = batch.shape[1:3]
+    if detect_size(width, height, detect_resolution) == (width, height):
+        return list(batch)
+    return [resize_image(frame, detect_resolution) for frame in batch]
+
+
+def dwpose_batch(dwpose, images, detect_resolution=512, image_resolution=512, output_type="pil", fp16=True):
+    """Run a DWposeDetector over a list of images, returning one pose map per image"""
+    frames = _prepare_frames(images, detect_resolution)
+
+    # Half precision only pays off on CUDA tensor cores, CPU inference stays in fp32
+    device_type = dwpose.pose_estimation.detector.data_preprocessor.device.type
+    autocast = torch.autocast("cuda", dtype=torch.float16, enabled=fp16 and device_type == "cuda")
+    with torch.inference_mode(), autocast:
+        poses = wholebody_batch(dwpose.pose_estimation, frames)
+        return [
+            _draw(frame, candidate, subset, image_resolution, output_type)
+            for frame, (candidate, subset) in zip(frames, poses)
+        ]
+
+
+def put_latest(queue: asyncio.Queue, item):
+    """Put item on a bounded queue, dropping the oldest entries to make room"""
+    while True:
+        try:
+            queue.put_nowait(item)
+            return
+        except asyncio.QueueFull:
+            queue.get_nowait()
+
+
+class PoseBatcher:
+    """Coalesces pose requests from all connected clients into batched DWpose calls"""
+
+    def __init__(self, dwpose, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT, fp16: bool = True):
+        self.dwpose = dwpose
+        self.fp16 = fp16
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        # A single thread keeps GPU work serialized while the event loop keeps serving clients
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dwpose")
+
+    def start(self):
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self.batch_worker())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        self.executor.shutdown(wait=False)
+
+    def warmup(self, batch_sizes=None):
+        """Run blank batches on the inference thread so compilation and engine setup happen before serving"""
+        frame = np.zeros((DETECT_RESOLUTION, DETECT_RESOLUTION, 3), dtype=np.uint8)
+        for batch_size in batch_sizes or (1, self.max_batch_size):
+            self.executor.submit(
+                partial(dwpose_batch, self.dwpose, [frame] * batch_size, output_type="np", fp16=self.fp16)
+            ).result()
+            logger.info(f"Warmed up pose detection for batch size {batch_size}")
+
+    async def enqueue(self, image):
+        """Queue an image for the next batch and wait for its pose map as an RGB array"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((image, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Requests whose client went away while queued are not worth a GPU slot
+        return [(image, future) for image, future in batch if not future.done()]
+
+    async def batch_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+
+            images = [image for image, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, partial(dwpose_batch, self.dwpose, images, output_type="np", fp16=self.fp16)
+                )
+            except Exception as e:
+                logger.error(f"Batched pose detection failed for {len(batch)} images: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            logger.debug(f"Ran pose detection on a batch of {len(batch)} images")
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,87 @@
+import io
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJFLAG_FASTDCT
+    turbo = TurboJPEG()
+except (ImportError, RuntimeError):
+    # PyTurboJPEG or the native libturbojpeg is missing, decode through Pillow(-SIMD) instead
+    turbo = None
+
+JPEG_QUALITY = 85
+DETECT_RESOLUTION = 512
+
+# Per-thread scratch arrays reused across frames, camera frames rarely change size
+_scratch = threading.local()
+
+
+def detect_size(width: int, height: int, resolution: int = DETECT_RESOLUTION):
+    """Size DWpose resizes a frame to before detection (see controlnet_aux.util.resize_image)"""
+    k = float(resolution) / min(width, height)
+    return int(np.round(width * k / 64.0)) * 64, int(np.round(height * k / 64.0)) * 64
+
+
+def _scratch_buffer(name: str, shape) -> np.ndarray:
+    buf = getattr(_scratch, name, None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        setattr(_scratch, name, buf)
+    return buf
+
+
+def _scaling_factor(width: int, height: int, resolution: int):
+    """Largest libjpeg DCT downscale that keeps the short side at or above resolution"""
+    # scaling_factors also lists upscales (9/8 ... 2/1), frames already near resolution decode at 1/1
+    factors = [
+        f for f in turbo.scaling_factors
+        if f[0] <= f[1] and min(width, height) * f[0] / f[1] >= resolution
+    ]
+    return min(factors, key=lambda f: f[0] / f[1], default=None)
+
+
+def decode_frame(image_bytes: bytes, resolution: int = DETECT_RESOLUTION) -> np.ndarray:
+    """Decode a mirrored camera frame into an RGB array at DWpose's detection size
+
+    The array may live in a per-thread scratch buffer, it is only valid until the
+    next decode_frame call on the same thread (process pool results are pickled first).
+    """
+    if turbo is None:
+        image = Image.open(io.BytesIO(image_bytes), formats=("JPEG",))
+        # Let libjpeg downscale in the DCT domain, same idea as the TurboJPEG scaling factor
+        image.draft("RGB", detect_size(*image.size, resolution))
+        frame = np.asarray(image.convert("RGB"))
+    else:
+        width, height = turbo.decode_header(image_bytes)[:2]
+        factor = _scaling_factor(width, height, resolution)
+        num, denom = factor or (1, 1)
+        # Same rounding as libjpeg's TJSCALED
+        shape = (-(-height * num // denom), -(-width * num // denom), 3)
+        frame = turbo.decode(
+            image_bytes,
+            pixel_format=TJPF_RGB,
+            scaling_factor=factor,
+            flags=TJFLAG_FASTDCT,
+            dst=_scratch_buffer("decoded", shape),
+        )
+
+    # Shrinking in uint8 here keeps DWpose's own resize and the tensors built from it small
+    height, width = frame.shape[:2]
+    if min(width, height) > resolution:
+        size = detect_size(width, height, resolution)
+        resized = _scratch_buffer("resized", (size[1], size[0], 3))
+        frame = cv2.resize(frame, size, dst=resized, interpolation=cv2.INTER_LINEAR)
+    # Mirror as a negative-stride view, DWpose copies the array anyway
+    return frame[:, ::-1]
+
+
+def encode_jpeg(image: np.ndarray, quality: int = JPEG_QUALITY) -> bytes:
+    """Encode an RGB uint8 array as JPEG bytes"""
+    bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=_scratch_buffer("bgr", image.shape))
+    ok, buf = cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buf.tobytes()
@@ -0,0 +1,82 @@
+import os
+import logging
+import multiprocessing
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from controlnet_aux import DWposeDetector
+
+from pose_batcher import PoseBatcher
+from pose_accel import enable_backend
+
+_detector: Optional[DWposeDetector] = None
+_batcher: Optional[PoseBatcher] = None
+_codec_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_detector() -> DWposeDetector:
+    """Process-wide DWposeDetector, loaded on first use"""
+    global _detector
+    if _detector is None:
+        _detector = DWposeDetector(device="cuda:0" if torch.cuda.is_available() else "cpu")
+    return _detector
+
+
+def get_batcher() -> PoseBatcher:
+    """Process-wide PoseBatcher so every endpoint in the process feeds the same batches"""
+    global _batcher
+    if _batcher is None:
+        _batcher = PoseBatcher(get_detector())
+    return _batcher
+
+
+async def close_batcher():
+    global _batcher
+    if _batcher is not None:
+        await _batcher.stop()
+        _batcher = None
+
+
+def _init_codec_worker():
+    # Nothing drains the parent's log queue in a forked worker, so don't feed it
+    logging.getLogger().handlers.clear()
+
+
+def get_codec_pool() -> ProcessPoolExecutor:
+    """Process-wide pool for JPEG decode/encode so the event loop only shuffles bytes
+
+    Call it before the model loads: the workers are forked, and forking once CUDA
+    is initialised and the inference thread is running is not safe.
+    """
+    global _codec_pool
+    if _codec_pool is None:
+        _codec_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_codec_worker,
+        )
+        # With fork the first submit starts every worker, do it now rather than on the first frame
+        _codec_pool.submit(int).result()
+    return _codec_pool
+
+
+def close_codec_pool():
+    global _codec_pool
+    if _codec_pool is not None:
+        _codec_pool.shutdown()
+        _codec_pool = None
+
+
+def init_pose_model(backend: str = "eager") -> PoseBatcher:
+    """Start the codec pool and load the model before serving rather than on the first request
+
+    The order matters: the codec workers are forked while the process is still free
+    of CUDA and the inference thread, and only then is the detector loaded.
+    """
+    get_codec_pool()
+    batcher = get_batcher()
+    if backend != "eager":
+        enable_backend(get_detector(), backend)
+        batcher.warmup()
+    return batcher
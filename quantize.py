@@ -0,0 +1,91 @@
+import os
+import glob
+import argparse
+import tempfile
+
+import numpy as np
+
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+from sp_logging import setup_logging
+from pose_codec import decode_frame
+from pose_model import get_detector
+from pose_batcher import dwpose_batch
+from pose_accel import ENGINE_DIR, export_onnx, int8_path
+
+logger = setup_logging()
+
+CALIBRATION_FRAMES = 200
+
+
+class FeatureInputReader(CalibrationDataReader):
+    """Feeds recorded feature extractor inputs to the ONNXRuntime calibrator, one file at a time"""
+
+    def __init__(self, paths):
+        self.paths = iter(paths)
+
+    def get_next(self):
+        path = next(self.paths, None)
+        return None if path is None else {"input": np.load(path)}
+
+
+def capture_inputs(dwpose, paths, out_dir):
+    """Run JPEG frames through DWpose and save what each backbone sees, crops included
+
+    Inputs go to .npy files in out_dir rather than memory, 200 detector inputs alone are ~1 GB.
+    """
+    captured = {"detector": [], "pose_estimator": []}
+
+    def record(name):
+        def hook(module, args):
+            path = os.path.join(out_dir, f"{name}_{len(captured[name]):05d}.npy")
+            np.save(path, args[0].float().cpu().numpy())
+            captured[name].append(path)
+        return hook
+
+    wholebody = dwpose.pose_estimation
+    hooks = [
+        wholebody.detector.backbone.register_forward_pre_hook(record("detector")),
+        wholebody.pose_estimator.backbone.register_forward_pre_hook(record("pose_estimator")),
+    ]
+    try:
+        for path in paths:
+            with open(path, "rb") as f:
+                frame = decode_frame(f.read())
+            # Calibrate on the fp32 activations the quantized graph will see
+            dwpose_batch(dwpose, [frame], output_type="np", fp16=False)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return captured
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the DWpose backbones to ONNX and quantize them to INT8")
+    parser.add_argument("frames", help="Directory of representative JPEG camera frames")
+    parser.add_argument("--limit", type=int, default=CALIBRATION_FRAMES, help="Maximum number of frames to calibrate on")
+    parser.add_argument("--engine-dir", default=ENGINE_DIR, help="Where to write the ONNX models")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.frames, "*.jp*g")))[:args.limit]
+    if not paths:
+        parser.error(f"No JPEG frames found in {args.frames}")
+
+    dwpose = get_detector()
+    with tempfile.TemporaryDirectory(prefix="calibration") as calibration_dir:
+        captured = capture_inputs(dwpose, paths, calibration_dir)
+        logger.info(f"Captured calibration inputs from {len(paths)} frames")
+
+        for name, path in export_onnx(dwpose, engine_dir=args.engine_dir).items():
+            output = int8_path(args.engine_dir, name)
+            # Per-tensor activations, per-channel conv weights, as QDQ nodes TensorRT can fuse
+            quantize_static(
+                path,
+                output,
+                FeatureInputReader(captured[name]),
+                quant_format=QuantFormat.QDQ,
+                per_channel=True,
+                activation_type=QuantType.QInt8,
+                weight_type=QuantType.QInt8,
+            )
+            logger.info(f"Wrote INT8 {name} to {output}")
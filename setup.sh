@@ -1,4 +1,5 @@
-pip install fastapi "uvicorn[standard]" Pillow controlnet-aux aiohttp aiortc aiohttp_cors
+apt-get install -y libturbojpeg
+pip install fastapi "uvicorn[standard]" Pillow controlnet-aux aiohttp aiortc aiohttp_cors PyTurboJPEG msgpack orjson
 pip install -U openmim
 mim install mmengine
 mim install "mmcv>=2.0.1"
@@ -10,3 +11,5 @@ mkdir /usr/local/lib/python3.10/dist-packages/controlnet_aux/dwpose/dwpose_confi
 wget "https://raw.githubusercontent.com/patrickvonplaten/controlnet_aux/84c6ecd5ad8a4ad781911d18e9545a71bc6b5a4c/src/controlnet_aux/dwpose/dwpose_config/dwpose-l_384x288.py" -O /usr/local/lib/python3.10/dist-packages/controlnet_aux/dwpose/dwpose_config/dwpose-l_384x288.py
 pip uninstall -y numpy
 pip install "numpy<2"
+apt-get install -y libjpeg-turbo8-dev zlib1g-dev
+CC="cc -mavx2" pip wheel --no-cache-dir --no-deps -w /tmp/pillow-simd pillow-simd && pip uninstall -y pillow && pip install /tmp/pillow-simd/*.whl
@@ -1,10 +1,10 @@
-import os, time, uuid, json, logging
+import os, time, uuid, json, queue, atexit, logging
 
 from typing import Optional
 from contextvars import ContextVar
 from fastapi import Request, Response
 from datetime import datetime, timezone
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from starlette.datastructures import Headers
 from starlette.middleware.base import BaseHTTPMiddleware
 
@@ -25,35 +25,37 @@ class RequestIdMiddleware(BaseHTTPMiddleware):
             process_time = (time.time() - start_time) * 1000  # ms
             
             logger = logging.getLogger("API_LOG")
-            status_code = response.status_code if response else 500
-            
-            headers: Headers = request.headers
-            headers_dict = dict(headers.items())
-            
-            x_forwarded_for = headers.get("x-forwarded-for")
-            x_real_ip = headers.get("x-real-ip")
-            client_host = request.client.host if request.client else ""
-            
-            log_data = {
-                "method": request.method,
-                "path": request.url.path,
-                "query_params": str(request.query_params) if request.query_params else "",
-                "status_code": status_code,
-                "duration_ms": f"{process_time:.2f}",
-                "client_host": client_host,
-                "x_forwarded_for": x_forwarded_for or "",
-                "x_real_ip": x_real_ip or "",
-                "host": f"{request.url.hostname}:{request.url.port}",
-                "content_length": response.headers.get("content-length", "") if response else "",
-                "protocol": request.scope.get("type", ""),
-                # Wrap in quotes using JSON encoding
-                "user_agent": json.dumps(headers.get("user-agent", "")),
-                "referer": json.dumps(headers.get("referer", "")),
-                # "headers": json.dumps(headers_dict)  # Log all headers
-            }
-            
-            log_message = " ".join([f"{k}={v}" for k, v in log_data.items()])
-            logger.info(log_message, extra={"request_id": request_id})
+            if logger.isEnabledFor(logging.INFO):
+                status_code = response.status_code if response else 500
+
+                headers: Headers = request.headers
+                # Read straight from the ASGI scope, request.url would build and parse a full URL
+                scope = request.scope
+                server = scope.get("server")
+
+                x_forwarded_for = headers.get("x-forwarded-for")
+                x_real_ip = headers.get("x-real-ip")
+                client_host = request.client.host if request.client else ""
+
+                log_data = {
+                    "method": request.method,
+                    "path": scope["path"],
+                    "query_params": str(request.query_params) if request.query_params else "",
+                    "status_code": status_code,
+                    "duration_ms": f"{process_time:.2f}",
+                    "client_host": client_host,
+                    "x_forwarded_for": x_forwarded_for or "",
+                    "x_real_ip": x_real_ip or "",
+                    "host": headers.get("host") or (f"{server[0]}:{server[1]}" if server else ""),
+                    "content_length": response.headers.get("content-length", "") if response else "",
+                    "protocol": scope.get("type", ""),
+                    # Wrap in quotes using JSON encoding
+                    "user_agent": json.dumps(headers.get("user-agent", "")),
+                    "referer": json.dumps(headers.get("referer", "")),
+                }
+
+                log_message = " ".join([f"{k}={v}" for k, v in log_data.items()])
+                logger.info(log_message, extra={"request_id": request_id})
 
 
 def generate_request_id():
@@ -74,6 +76,14 @@ class ISO8601UTCFormatter(logging.Formatter):
         dt = datetime.fromtimestamp(record.created, timezone.utc)
         return dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
 
+_listener = None
+
+@atexit.register
+def _stop_listener():
+    # Flush whatever is still queued before the interpreter exits
+    if _listener is not None:
+        _listener.stop()
+
 def setup_logging(
     log_file=None,
     log_level=logging.INFO,
@@ -90,6 +100,10 @@ def setup_logging(
     else:
         log_file = os.path.join(log_dir, log_file)
 
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level)
     for handler in root_logger.handlers[:]:
@@ -106,15 +120,20 @@ def setup_logging(
     )
     file_handler.setFormatter(formatter)
     file_handler.setLevel(log_level)
-    file_handler.addFilter(request_id_filter)
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
     console_handler.setLevel(log_level)
-    console_handler.addFilter(request_id_filter)
 
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    # Callers only enqueue records, formatting and file/stderr I/O happen on the listener thread.
+    # The request id filter stays on the queue side since context vars don't cross threads.
+    log_queue = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(request_id_filter)
+    root_logger.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
 
     return root_logger
 
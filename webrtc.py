@@ -4,25 +4,29 @@ import logging
 import uuid
 import time
 import base64
-import io
 import re
 import os
 from typing import Dict, Set, Optional
-from dataclasses import dataclass
-from PIL import Image
+from dataclasses import dataclass, field
 
-import torch
+import msgpack
+import orjson
 from aiohttp import web, WSMsgType
 from aiohttp_cors import setup, ResourceOptions
 from aiortc import RTCPeerConnection, RTCSessionDescription, RTCDataChannel
 
-from controlnet_aux import DWposeDetector
 from sp_logging import setup_logging
+from pose_batcher import put_latest
+from pose_model import init_pose_model, get_batcher, close_batcher, get_codec_pool, close_codec_pool
+from pose_codec import decode_frame, encode_jpeg
+from pose_accel import BACKENDS
 
 logger = setup_logging()
 
-# Global pose detector
-dwpose = DWposeDetector(device="cuda:0" if torch.cuda.is_available() else "cpu")
+HANDLE_RE = re.compile(r'^[a-zA-Z0-9_]+$')
+
+# Raw data channel messages buffered per peer before the oldest are dropped
+INBOX_SIZE = 32
 
 @dataclass
 class PeerInfo:
@@ -30,6 +34,12 @@ class PeerInfo:
     handle: str
     peer_connection: RTCPeerConnection
     data_channel: Optional[RTCDataChannel] = None
+    # Incoming messages are handled in order by one consumer task instead of a task per message
+    inbox: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=INBOX_SIZE))
+    message_task: Optional[asyncio.Task] = None
+    # Only the newest pose request is kept, stale frames are dropped instead of queueing up
+    pose_requests: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=1))
+    pose_task: Optional[asyncio.Task] = None
 
 class WebRTCPoseServer:
     def __init__(self, password: str, cors_origin: str):
@@ -41,7 +51,7 @@ class WebRTCPoseServer:
         
     def _validate_handle(self, handle: str) -> bool:
         """Validate handle contains only letters, numbers, and underscores"""
-        return bool(re.match(r'^[a-zA-Z0-9_]+$', handle))
+        return bool(HANDLE_RE.match(handle))
         
     async def handle_websocket(self, request):
         """Handle WebSocket connections for status updates only"""
@@ -119,12 +129,18 @@ class WebRTCPoseServer:
             log_info("Data channel %s received", channel.label)
             
             # Store the data channel reference
-            if peer_id in self.peers:
-                self.peers[peer_id].data_channel = channel
+            peer_info = self.peers.get(peer_id)
+            if peer_info:
+                peer_info.data_channel = channel
+                if peer_info.message_task is None:
+                    peer_info.message_task = asyncio.create_task(self.message_loop(peer_id))
+                if peer_info.pose_task is None:
+                    peer_info.pose_task = asyncio.create_task(self.pose_loop(peer_id))
             
             @channel.on("message")
             def on_message(message):
-                asyncio.create_task(self.handle_data_channel_message(peer_id, message))
+                if peer_info:
+                    put_latest(peer_info.inbox, message)
 
         @pc.on("connectionstatechange")
         async def on_connectionstatechange():
@@ -133,7 +149,12 @@ class WebRTCPoseServer:
                 await pc.close()
                 self.pcs.discard(pc)
                 # Remove peer and broadcast updated count
-                if self.peers.pop(peer_id, None):
+                peer_info = self.peers.pop(peer_id, None)
+                if peer_info:
+                    if peer_info.message_task:
+                        peer_info.message_task.cancel()
+                    if peer_info.pose_task:
+                        peer_info.pose_task.cancel()
                     log_info("Peer %s removed, remaining peers: %d", handle, len(self.peers))
                     await self.broadcast_peer_count()
             elif pc.connectionState == "connected":
@@ -158,66 +179,97 @@ class WebRTCPoseServer:
             })
         )
     
-    async def handle_data_channel_message(self, peer_id: str, message: str):
-        """Handle messages received through data channel"""
+    async def handle_data_channel_message(self, peer_id: str, message):
+        """Handle messages received through data channel (JSON text or msgpack binary)"""
         try:
-            data = json.loads(message)
+            data = msgpack.unpackb(message) if isinstance(message, bytes) else orjson.loads(message)
             message_type = data.get('type')
             
             if message_type == 'pose_request':
-                await self.process_pose_request(peer_id, data)
+                peer_info = self.peers.get(peer_id)
+                if peer_info:
+                    put_latest(peer_info.pose_requests, data)
             else:
                 # Broadcast to other peers
                 await self.broadcast_to_others(peer_id, data)
                 
-        except json.JSONDecodeError:
-            logger.error(f"Invalid JSON in data channel message from {peer_id}")
+        except ValueError:
+            logger.error(f"Invalid JSON or msgpack in data channel message from {peer_id}")
         except Exception as e:
             logger.error(f"Error handling data channel message from {peer_id}: {e}")
     
+    async def message_loop(self, peer_id: str):
+        """Handle a peer's data channel messages in arrival order"""
+        peer_info = self.peers.get(peer_id)
+        if peer_info is None:
+            return
+        while True:
+            message = await peer_info.inbox.get()
+            await self.handle_data_channel_message(peer_id, message)
+
+    async def pose_loop(self, peer_id: str):
+        """Process a peer's pose requests one at a time, always taking the newest frame"""
+        peer_info = self.peers.get(peer_id)
+        if peer_info is None:
+            return
+        while True:
+            data = await peer_info.pose_requests.get()
+            await self.process_pose_request(peer_id, data)
+
     async def process_pose_request(self, peer_id: str, data: dict):
         """Process pose detection request"""
+        loop = asyncio.get_running_loop()
         try:
-            # Extract image data
-            image_data = data.get('image', '').split(',')[-1]
-            if not image_data:
-                return
+            # Extract image data, msgpack requests carry raw JPEG bytes instead of a data URL
+            image = data.get('image', '')
+            binary = isinstance(image, bytes)
+            if binary:
+                image_bytes = image
+            else:
+                image_data = image.split(',')[-1]
+                if not image_data:
+                    return
 
-            # Decode and process image with proper error handling
-            try:
-                image_bytes = base64.b64decode(image_data, validate=True)
-            except Exception as e:
-                logger.error(f"Invalid base64 image data from {peer_id}: {e}")
+                # Decode and process image with proper error handling
+                try:
+                    image_bytes = base64.b64decode(image_data, validate=True)
+                except Exception as e:
+                    logger.error(f"Invalid base64 image data from {peer_id}: {e}")
+                    return
+
+            if not image_bytes:
                 return
-                
+
             try:
-                image = Image.open(io.BytesIO(image_bytes))
-                image = image.transpose(Image.FLIP_LEFT_RIGHT)
+                image = await loop.run_in_executor(get_codec_pool(), decode_frame, image_bytes)
             except Exception as e:
                 logger.error(f"Invalid image format from {peer_id}: {e}")
                 return
 
             start_time = time.time()
-            result = dwpose(image, output_type="pil", include_hands=True, include_face=True)
+            result = await get_batcher().enqueue(image)
             end_time = time.time()
 
             execution_time = end_time - start_time
             logger.debug(f"Pose detection took {execution_time:.4f} seconds")
 
-            buffered = io.BytesIO()
-            result.save(buffered, format="JPEG", quality=85)
-            result_image = base64.b64encode(buffered.getvalue()).decode()
+            result_jpeg = await loop.run_in_executor(get_codec_pool(), encode_jpeg, result)
 
             # Send result back to requesting peer
             peer_info = self.peers.get(peer_id)
             if peer_info and peer_info.data_channel and peer_info.data_channel.readyState == "open":
                 response_data = {
                     'type': 'pose_response',
-                    'image': f"data:image/jpeg;base64,{result_image}",
                     'execution_time': execution_time
                 }
+                if binary:
+                    response_data['image'] = result_jpeg
+                    response = msgpack.packb(response_data, use_bin_type=True)
+                else:
+                    response_data['image'] = f"data:image/jpeg;base64,{base64.b64encode(result_jpeg).decode()}"
+                    response = orjson.dumps(response_data).decode()
                 try:
-                    peer_info.data_channel.send(json.dumps(response_data))
+                    peer_info.data_channel.send(response)
                     logger.debug(f"Sent pose response to peer {peer_id} (took {execution_time:.4f}s)")
                 except Exception as e:
                     logger.error(f"Error sending pose response to {peer_id}: {e}")
@@ -291,6 +343,11 @@ async def on_shutdown(app):
     # Get server instance and close peer connections
     server = getattr(app, '_webrtc_server', None)
     if server:
+        for peer_info in server.peers.values():
+            if peer_info.message_task:
+                peer_info.message_task.cancel()
+            if peer_info.pose_task:
+                peer_info.pose_task.cancel()
         coros = [pc.close() for pc in server.pcs]
         await asyncio.gather(*coros)
         server.pcs.clear()
@@ -301,14 +358,19 @@ async def on_shutdown(app):
             if not ws.closed:
                 await ws.close()
 
+    await close_batcher()
+    close_codec_pool()
+
 if __name__ == '__main__':
     import argparse
+    import uvloop
     
     parser = argparse.ArgumentParser(description="WebRTC Pose Server")
     parser.add_argument("--host", default="0.0.0.0", help="Host to bind to")
     parser.add_argument("--port", type=int, default=8020, help="Port to bind to")
     parser.add_argument("--password", required=True, help="Room password for WebRTC connections")
     parser.add_argument("--cors-origin", required=True, help="CORS origin (required)")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager", help="How to run the pose backbones")
     parser.add_argument("--verbose", "-v", action="count", default=0)
     
     args = parser.parse_args()
@@ -318,9 +380,12 @@ if __name__ == '__main__':
     else:
         logging.basicConfig(level=logging.INFO)
     
+    init_pose_model(args.backend)
+
     app = create_app(args.password, args.cors_origin)
     app.on_shutdown.append(on_shutdown)
     logger.info(f"Starting WebRTC Pose Server on {args.host}:{args.port}")
     logger.info(f"CORS origin: {args.cors_origin}")
     
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     web.run_app(app, host=args.host, port=args.port)